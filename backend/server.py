@@ -1,10 +1,17 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Query
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import os
+import asyncio
 import logging
+import shutil
+import resource
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
 from typing import List, Optional, Dict, Any
@@ -13,6 +20,11 @@ from datetime import datetime, timezone, timedelta
 import jwt
 import bcrypt
 import math
+import csv
+import io
+import json
+import hashlib
+import numpy as np
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -41,6 +53,28 @@ MIN_PLAY_TIME_MINUTES = 60
 MIN_GAMES_PLAYED = 3
 MIN_SESSION_TIME_FOR_AD = 30  # seconds
 
+# Ads events archive (events older than the retention move to daily .npy partitions)
+ADS_EVENTS_RETENTION_DAYS = int(os.environ.get('ADS_EVENTS_RETENTION_DAYS', '35'))
+ADS_ARCHIVE_DIR = Path(os.environ.get('ADS_ARCHIVE_DIR', str(ROOT_DIR / 'archive' / 'ads_events')))
+ARCHIVE_CATEGORICAL_COLUMNS = ("user_id", "ad_type", "game_id")
+ARCHIVE_LOCK_SECONDS = 3600
+if ADS_EVENTS_RETENTION_DAYS < 1:
+    raise ValueError("ADS_EVENTS_RETENTION_DAYS must be at least 1")
+
+# Push channel (Server-Sent Events)
+# Unset MAX_STREAM_CONNECTIONS means: derive the cap from the open-files limit at startup
+MAX_STREAM_CONNECTIONS = int(os.environ['MAX_STREAM_CONNECTIONS']) if 'MAX_STREAM_CONNECTIONS' in os.environ else None
+MAX_STREAMS_PER_USER = 3
+MAX_STREAMS_PER_CLIENT = int(os.environ.get('MAX_STREAMS_PER_CLIENT', '100'))
+# Proxies in front of the app; the client address is taken that many hops from the end of X-Forwarded-For
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '1'))
+STREAM_QUEUE_SIZE = 16
+STREAM_KEEPALIVE_SECONDS = 25
+STREAM_FULL_RETRY_MS = 30000
+
+# Fields get_ad_status needs, read back after an ad is recorded
+AD_STATUS_PROJECTION = {"_id": 0, "id": 1, "coins": 1, "ads_today_count": 1, "ads_timestamps": {"$slice": -1}}
+
 # Create the main app
 app = FastAPI(title="Jogar Ganhar API")
 api_router = APIRouter(prefix="/api")
@@ -114,7 +148,82 @@ class AdminAction(BaseModel):
     action: str  # "approve" or "reject"
     reason: Optional[str] = None
 
+class AdminBulkAction(BaseModel):
+    withdrawal_ids: List[str]
+    action: str  # "approve" or "reject"
+    reason: Optional[str] = None
+
+# Pub/sub
+class InProcessBroker:
+    """Fan out user events to the streams connected to this worker.
+
+    With several workers, replace `broker` with an implementation backed by a
+    shared broker that exposes the same subscribe/unsubscribe/publish methods.
+    """
+
+    def __init__(self, max_connections: int, max_per_user: int, max_per_client: int):
+        self.max_connections = max_connections
+        self.max_per_user = max_per_user
+        self.max_per_client = max_per_client
+        self.subscribers: Dict[str, set] = {}
+        self.clients: Dict[str, int] = {}
+        self.connections = 0
+
+    def capacity_error(self, user_id: str, client: str) -> Optional[HTTPException]:
+        if self.connections >= self.max_connections:
+            return HTTPException(status_code=503, detail="Too many connections")
+        if len(self.subscribers.get(user_id, ())) >= self.max_per_user:
+            return HTTPException(status_code=429, detail="Too many connections for this user")
+        if self.clients.get(client, 0) >= self.max_per_client:
+            return HTTPException(status_code=429, detail="Too many connections from this client")
+        return None
+
+    def subscribe(self, user_id: str, client: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.subscribers.setdefault(user_id, set()).add(queue)
+        self.clients[client] = self.clients.get(client, 0) + 1
+        self.connections += 1
+        return queue
+
+    def unsubscribe(self, user_id: str, client: str, queue: asyncio.Queue) -> None:
+        queues = self.subscribers.get(user_id)
+        if not queues or queue not in queues:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[user_id]
+        self.clients[client] -= 1
+        if not self.clients[client]:
+            del self.clients[client]
+        self.connections -= 1
+
+    async def publish(self, user_id: str, event: dict) -> None:
+        for queue in self.subscribers.get(user_id, ()):
+            if queue.full():
+                # Slow client: drop the oldest event, newer state supersedes it
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+def stream_connection_cap(open_files: int) -> int:
+    """Streams allowed with the given open-files limit, keeping 1024 for Mongo and regular requests"""
+    if MAX_STREAM_CONNECTIONS is not None:
+        return MAX_STREAM_CONNECTIONS
+    return max(0, min(50000, open_files - 1024))
+
+broker = InProcessBroker(
+    stream_connection_cap(resource.getrlimit(resource.RLIMIT_NOFILE)[0]),
+    MAX_STREAMS_PER_USER,
+    MAX_STREAMS_PER_CLIENT
+)
+
 # Helper functions
+def client_address(request: Request) -> str:
+    """Client IP, read from X-Forwarded-For as appended by the trusted proxies"""
+    forwarded = [ip.strip() for ip in request.headers.get("x-forwarded-for", "").split(",") if ip.strip()]
+    if TRUSTED_PROXY_HOPS and len(forwarded) >= TRUSTED_PROXY_HOPS:
+        return forwarded[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
@@ -165,6 +274,15 @@ async def check_and_reset_daily(user: dict) -> dict:
     
     return user
 
+async def publish_balance(user_id: str, coins: int, **extra) -> None:
+    """Push the current balance to the user's open streams"""
+    await broker.publish(user_id, {
+        "type": "balance",
+        "coins": coins,
+        "money_balance": round(coins / COINS_PER_CENT, 2),
+        **extra
+    })
+
 async def get_ads_last_hour(user_id: str) -> List[dict]:
     """Get ads watched in the last hour"""
     one_hour_ago = datetime.now(timezone.utc) - timedelta(hours=1)
@@ -201,6 +319,453 @@ async def check_fraud_signals(user_id: str) -> bool:
     
     return False
 
+# Ads events archive helpers
+def _to_datetime64(timestamp: str) -> np.datetime64:
+    dt = datetime.fromisoformat(timestamp).astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(dt, 'us')
+
+def _from_datetime64(value: np.datetime64) -> str:
+    return value.astype(datetime).replace(tzinfo=timezone.utc).isoformat()
+
+def _archive_partition_dir(day: str) -> Path:
+    return ADS_ARCHIVE_DIR / f"day={day}"
+
+def list_archived_days() -> List[str]:
+    """List archived days (YYYY-MM-DD), oldest first"""
+    if not ADS_ARCHIVE_DIR.is_dir():
+        return []
+    return sorted(p.name[len("day="):] for p in ADS_ARCHIVE_DIR.glob("day=*") if p.is_dir())
+
+def write_ads_partition(day: str, events: List[dict]) -> None:
+    """Write one day of ads events as columnar .npy files.
+
+    String columns are dictionary-encoded (int32 codes plus a vocab file) and
+    event ids are stored as 16 raw UUID bytes per row (uint8 matrix). Each
+    write goes to a new hidden version directory; day=<day> is a symlink to
+    the current version.
+    """
+    path = _archive_partition_dir(day)
+    tmp = ADS_ARCHIVE_DIR / f".{path.name}.{uuid.uuid4().hex}"
+    tmp.mkdir(parents=True)
+    
+    events = sorted(events, key=lambda e: e['timestamp'])
+    for column in ARCHIVE_CATEGORICAL_COLUMNS:
+        values = np.array([e.get(column) or "" for e in events], dtype=str)
+        vocab, codes = np.unique(values, return_inverse=True)
+        np.save(tmp / f"{column}.vocab.npy", vocab)
+        np.save(tmp / f"{column}.npy", codes.astype(np.int32))
+    ids = b"".join(uuid.UUID(e['id']).bytes for e in events)
+    np.save(tmp / "id.npy", np.frombuffer(ids, dtype=np.uint8).reshape(len(events), 16))
+    np.save(tmp / "timestamp.npy", np.array([_to_datetime64(e['timestamp']) for e in events], dtype='datetime64[us]'))
+    np.save(tmp / "reward_amount.npy", np.array([e.get('reward_amount', 0) for e in events], dtype=np.int32))
+    np.save(tmp / "reward_granted.npy", np.array([bool(e.get('reward_granted')) for e in events], dtype=bool))
+    
+    # Swap the symlink atomically so readers never see a missing or half-written day
+    previous = path.resolve() if path.is_symlink() else None
+    link = ADS_ARCHIVE_DIR / f".{path.name}.{uuid.uuid4().hex}.link"
+    link.symlink_to(tmp.name)
+    os.replace(link, path)
+    if previous is not None:
+        shutil.rmtree(previous, ignore_errors=True)
+
+def load_ads_partition(day: str) -> Optional[Dict[str, np.ndarray]]:
+    """Memory-map the columns of one archived day"""
+    for attempt in range(3):
+        path = _archive_partition_dir(day).resolve()
+        if not path.is_dir():
+            return None
+        try:
+            columns = {
+                name: np.load(path / f"{name}.npy", mmap_mode="r")
+                for name in ("id", "timestamp", "reward_amount", "reward_granted") + ARCHIVE_CATEGORICAL_COLUMNS
+            }
+            for column in ARCHIVE_CATEGORICAL_COLUMNS:
+                columns[f"{column}_vocab"] = np.load(path / f"{column}.vocab.npy")
+            return columns
+        except FileNotFoundError:
+            # The version was replaced while loading; follow the symlink again
+            if attempt == 2:
+                raise
+    return None
+
+def _vocab_code(vocab: np.ndarray, value: str) -> Optional[int]:
+    code = int(np.searchsorted(vocab, value))
+    if code < len(vocab) and vocab[code] == value:
+        return code
+    return None
+
+def _partition_row(columns: Dict[str, np.ndarray], i: int) -> dict:
+    return {
+        "id": str(uuid.UUID(bytes=columns['id'][i].tobytes())),
+        "user_id": str(columns['user_id_vocab'][columns['user_id'][i]]),
+        "ad_type": str(columns['ad_type_vocab'][columns['ad_type'][i]]),
+        "game_id": str(columns['game_id_vocab'][columns['game_id'][i]]) or None,
+        "timestamp": _from_datetime64(columns['timestamp'][i]),
+        "reward_amount": int(columns['reward_amount'][i]),
+        "reward_granted": bool(columns['reward_granted'][i])
+    }
+
+def read_archived_ads_events(user_id: Optional[str] = None, since: Optional[str] = None,
+                             reward_granted: Optional[bool] = None, limit: Optional[int] = None,
+                             days: Optional[List[str]] = None) -> List[dict]:
+    """Read archived ads events, newest first, optionally only from the given days"""
+    if days is None:
+        days = list_archived_days()
+    
+    rows = []
+    for day in sorted(days, reverse=True):
+        if since and day < since[:10]:
+            break
+        columns = load_ads_partition(day)
+        if columns is None:
+            continue
+        
+        mask = np.ones(len(columns['timestamp']), dtype=bool)
+        if user_id is not None:
+            code = _vocab_code(columns['user_id_vocab'], user_id)
+            if code is None:
+                continue
+            mask &= columns['user_id'] == code
+        if reward_granted is not None:
+            mask &= columns['reward_granted'] == reward_granted
+        if since:
+            mask &= columns['timestamp'] >= _to_datetime64(since)
+        
+        indexes = np.nonzero(mask)[0][::-1]
+        if limit is not None:
+            indexes = indexes[:limit - len(rows)]
+        rows.extend(_partition_row(columns, i) for i in indexes)
+        if limit is not None and len(rows) >= limit:
+            break
+    return rows
+
+def archived_coins_by_user(since: str) -> Dict[str, int]:
+    """Sum rewarded coins per user in archived days since a timestamp"""
+    totals: Dict[str, int] = {}
+    for day in list_archived_days():
+        if day < since[:10]:
+            continue
+        columns = load_ads_partition(day)
+        if columns is None:
+            continue
+        vocab = columns['user_id_vocab']
+        mask = columns['reward_granted'] & (columns['timestamp'] >= _to_datetime64(since))
+        sums = np.bincount(columns['user_id'][mask], weights=columns['reward_amount'][mask], minlength=len(vocab))
+        for code in np.nonzero(sums)[0]:
+            user_id = str(vocab[code])
+            totals[user_id] = totals.get(user_id, 0) + int(sums[code])
+    return totals
+
+async def find_ads_events(user_id: str, reward_granted: Optional[bool] = None, limit: int = 30) -> List[dict]:
+    """Latest ads events of a user, spanning Mongo and the archive"""
+    query = {"user_id": user_id}
+    if reward_granted is not None:
+        query["reward_granted"] = reward_granted
+    events = await db.ads_events.find(query, {"_id": 0}).sort("timestamp", -1).limit(limit).to_list(None)
+    
+    if len(events) < limit:
+        # The rollup says which archived days hold this user's events; each has at least one
+        counter = "rewarded_events" if reward_granted is True else "events"
+        days = await db.ads_events_rollup.find(
+            {"user_id": user_id, counter: {"$gt": 0}},
+            {"_id": 0, "day": 1}
+        ).sort("day", -1).limit(limit - len(events)).to_list(None)
+        if days:
+            events += await asyncio.to_thread(
+                read_archived_ads_events,
+                user_id=user_id,
+                reward_granted=reward_granted,
+                limit=limit - len(events),
+                days=[d['day'] for d in days]
+            )
+    return events
+
+async def coins_earned_by_user(since: str, limit: int) -> List[dict]:
+    """Top users by rewarded coins since a timestamp, spanning Mongo and the archive"""
+    archived = await asyncio.to_thread(archived_coins_by_user, since)
+    
+    pipeline = [
+        {"$match": {"timestamp": {"$gte": since}, "reward_granted": True}},
+        {"$group": {"_id": "$user_id", "coins_earned": {"$sum": "$reward_amount"}}},
+        {"$sort": {"coins_earned": -1}}
+    ]
+    if not archived:
+        pipeline.append({"$limit": limit})
+    
+    totals = {item['_id']: item['coins_earned'] for item in await db.ads_events.aggregate(pipeline).to_list(None)}
+    for user_id, coins in archived.items():
+        totals[user_id] = totals.get(user_id, 0) + coins
+    
+    ranked = sorted(totals.items(), key=lambda x: x[1], reverse=True)[:limit]
+    return [{"_id": user_id, "coins_earned": coins} for user_id, coins in ranked]
+
+def merge_ads_partition(day: str, events: List[dict]) -> List[dict]:
+    """Merge events into a day partition left by an earlier run and rewrite it"""
+    merged = {}
+    existing = load_ads_partition(day)
+    if existing is not None:
+        for i in range(len(existing['timestamp'])):
+            row = _partition_row(existing, i)
+            merged[row['id']] = row
+    for e in events:
+        merged[e['id']] = e
+    
+    write_ads_partition(day, list(merged.values()))
+    return list(merged.values())
+
+async def acquire_job_lock(name: str, seconds: int) -> Optional[str]:
+    """Take a lease on a named job, returning the owner token or None if held"""
+    owner = str(uuid.uuid4())
+    now = datetime.now(timezone.utc)
+    try:
+        await db.job_locks.find_one_and_update(
+            {"_id": name, "expires_at": {"$lt": now.isoformat()}},
+            {"$set": {"owner": owner, "expires_at": (now + timedelta(seconds=seconds)).isoformat()}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return None
+    return owner
+
+async def renew_job_lock(name: str, owner: str, seconds: int) -> None:
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=seconds)
+    await db.job_locks.update_one({"_id": name, "owner": owner}, {"$set": {"expires_at": expires_at.isoformat()}})
+
+async def release_job_lock(name: str, owner: str) -> None:
+    await db.job_locks.delete_one({"_id": name, "owner": owner})
+
+async def archive_ads_events(retention_days: int = ADS_EVENTS_RETENTION_DAYS) -> dict:
+    """Move ads events older than the retention into daily archive partitions"""
+    if retention_days < 1:
+        raise HTTPException(status_code=400, detail="retention_days must be at least 1")
+    
+    owner = await acquire_job_lock("archive_ads_events", ARCHIVE_LOCK_SECONDS)
+    if owner is None:
+        raise HTTPException(status_code=409, detail="Archive job already running")
+    try:
+        return await _archive_ads_events(retention_days, owner)
+    finally:
+        await release_job_lock("archive_ads_events", owner)
+
+async def _archive_ads_events(retention_days: int, owner: str) -> dict:
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=retention_days)).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    days = await db.ads_events.aggregate([
+        {"$match": {"timestamp": {"$lt": cutoff.isoformat()}}},
+        {"$group": {"_id": {"$substrCP": ["$timestamp", 0, 10]}}},
+        {"$sort": {"_id": 1}}
+    ]).to_list(None)
+    
+    archived_count = 0
+    for item in days:
+        day = item['_id']
+        day_start = datetime.fromisoformat(day).replace(tzinfo=timezone.utc)
+        events = await db.ads_events.find({
+            "timestamp": {"$gte": day_start.isoformat(), "$lt": (day_start + timedelta(days=1)).isoformat()}
+        }, {"_id": 0}).to_list(None)
+        if not events:
+            continue
+        
+        await renew_job_lock("archive_ads_events", owner, ARCHIVE_LOCK_SECONDS)
+        merged = await asyncio.to_thread(merge_ads_partition, day, events)
+        
+        # Keep a per-user daily rollup in Mongo
+        rollup: Dict[str, dict] = {}
+        for e in merged:
+            r = rollup.setdefault(e['user_id'], {
+                "day": day, "user_id": e['user_id'], "events": 0, "rewarded_events": 0, "coins_earned": 0
+            })
+            r['events'] += 1
+            if e.get('reward_granted'):
+                r['rewarded_events'] += 1
+                r['coins_earned'] += e.get('reward_amount', 0)
+        await db.ads_events_rollup.delete_many({"day": day})
+        await db.ads_events_rollup.insert_many(list(rollup.values()))
+        
+        await db.ads_events.delete_many({"id": {"$in": [e['id'] for e in events]}})
+        archived_count += len(events)
+    
+    return {"archived_events": archived_count, "days": [item['_id'] for item in days], "cutoff": cutoff.isoformat()}
+
+async def refund_withdrawals(withdrawals: List[dict]) -> None:
+    """Refund rejected withdrawals that still have refund_pending set"""
+    if not withdrawals:
+        return
+    
+    # Each refund is tagged on the user for good: concurrent or retried calls
+    # holding the same pending snapshot cannot pay it twice
+    await db.users.bulk_write(
+        [
+            UpdateOne(
+                {"id": w['user_id'], "refunded_withdrawals": {"$ne": w['id']}},
+                {"$inc": {"coins": w['coins_deducted']}, "$addToSet": {"refunded_withdrawals": w['id']}}
+            )
+            for w in withdrawals
+        ],
+        ordered=False
+    )
+    await db.withdrawals.update_many(
+        {"id": {"$in": [w['id'] for w in withdrawals]}},
+        {"$set": {"refund_pending": False}}
+    )
+    
+    users = await db.users.find(
+        {"id": {"$in": list({w['user_id'] for w in withdrawals})}},
+        {"_id": 0, "id": 1, "coins": 1}
+    ).to_list(None)
+    for user in users:
+        await publish_balance(user['id'], user['coins'])
+
+async def apply_withdrawal_action(withdrawal_ids: List[str], action: str, reason: Optional[str] = None) -> List[dict]:
+    """Approve or reject pending withdrawals, refunding rejected coins"""
+    if action not in ("approve", "reject"):
+        raise HTTPException(status_code=400, detail="Invalid action")
+    
+    batch_id = str(uuid.uuid4())
+    update = {
+        "status": "processed" if action == "approve" else "rejected",
+        "processed_at": datetime.now(timezone.utc).isoformat(),
+        "batch_id": batch_id
+    }
+    if action == "reject":
+        update["reject_reason"] = reason
+        update["refund_pending"] = True
+    
+    # Guard on "pending" so a withdrawal is only claimed (and refunded) once
+    await db.withdrawals.update_many(
+        {"id": {"$in": withdrawal_ids}, "status": "pending"},
+        {"$set": update}
+    )
+    claimed = await db.withdrawals.find(
+        {"id": {"$in": withdrawal_ids}, "batch_id": batch_id},
+        {"_id": 0}
+    ).to_list(None)
+    
+    for w in claimed:
+        await broker.publish(w['user_id'], {
+            "type": "withdrawal",
+            "withdrawal_id": w['id'],
+            "status": w['status'],
+            "processed_at": w['processed_at']
+        })
+    
+    if action == "reject":
+        await refund_withdrawals(claimed)
+    
+    return claimed
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+async def get_ad_status(user: dict) -> dict:
+    """Check daily, hourly and cooldown ad limits for a user"""
+    now = datetime.now(timezone.utc)
+    
+    # Get last hour ads
+    last_hour_ads = await get_ads_last_hour(user['id'])
+    ads_last_hour_count = len(last_hour_ads)
+    
+    # Check daily limit
+    if user['ads_today_count'] >= DAILY_AD_LIMIT:
+        return {
+            "allow": True,
+            "allowReward": False,
+            "reason": "daily_limit_reached",
+            "next_allowed_time": (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
+        }
+    
+    # Check hourly limit
+    if ads_last_hour_count >= HOURLY_AD_LIMIT:
+        # Find oldest ad in last hour
+        oldest_ad = min(last_hour_ads, key=lambda x: x['timestamp'])
+        next_time = datetime.fromisoformat(oldest_ad['timestamp']) + timedelta(hours=1)
+        
+        return {
+            "allow": True,
+            "allowReward": False,
+            "reason": "hourly_limit_reached",
+            "next_allowed_time": next_time.isoformat(),
+            "ads_last_hour": ads_last_hour_count
+        }
+    
+    # Check cooldown
+    ads_timestamps = user.get('ads_timestamps', [])
+    if ads_timestamps:
+        last_ad_time = datetime.fromisoformat(ads_timestamps[-1])
+        time_since_last = (now - last_ad_time).total_seconds()
+        
+        if time_since_last < AD_COOLDOWN_SECONDS:
+            next_time = last_ad_time + timedelta(seconds=AD_COOLDOWN_SECONDS)
+            return {
+                "allow": False,
+                "allowReward": False,
+                "reason": "cooldown",
+                "next_allowed_time": next_time.isoformat(),
+                "seconds_remaining": int(AD_COOLDOWN_SECONDS - time_since_last)
+            }
+    
+    return {
+        "allow": True,
+        "allowReward": True,
+        "ads_today_count": user['ads_today_count'],
+        "ads_last_hour": ads_last_hour_count
+    }
+
+async def get_withdraw_errors(user: dict, amount: float) -> List[str]:
+    """Collect the reasons a user cannot withdraw the given amount"""
+    errors = []
+    
+    money_balance = user['coins'] / COINS_PER_CENT
+    
+    if not user['daily_access_unlocked']:
+        errors.append("Você precisa assistir 5 anúncios diários para liberar o saque")
+    
+    if not user['first_game_ad_done']:
+        errors.append("Você precisa assistir o anúncio ao entrar no jogo")
+    
+    if money_balance < MIN_WITHDRAW_BRL:
+        errors.append(f"Saldo mínimo: R$ {MIN_WITHDRAW_BRL:.2f}")
+    
+    if user['total_play_time'] < MIN_PLAY_TIME_MINUTES * 60:
+        errors.append(f"Tempo mínimo de jogo: {MIN_PLAY_TIME_MINUTES} minutos")
+    
+    if len(user.get('games_played_distinct', [])) < MIN_GAMES_PLAYED:
+        errors.append(f"Você precisa jogar pelo menos {MIN_GAMES_PLAYED} jogos diferentes")
+    
+    if user['suspect_flag']:
+        errors.append("Sua conta está sob análise. Entre em contato com o suporte.")
+    
+    # Check device cooldown
+    last_withdraw = await db.withdrawals.find_one(
+        {"device_id": user['device_id'], "status": "processed"},
+        sort=[("processed_at", -1)]
+    )
+    
+    if last_withdraw and last_withdraw.get('processed_at'):
+        last_time = datetime.fromisoformat(last_withdraw['processed_at'])
+        hours_since = (datetime.now(timezone.utc) - last_time).total_seconds() / 3600
+        if hours_since < WITHDRAW_DEVICE_COOLDOWN_HOURS:
+            errors.append(f"Aguarde {int(WITHDRAW_DEVICE_COOLDOWN_HOURS - hours_since)}h para próximo saque")
+    
+    # Check weekly limit
+    week_ago = datetime.now(timezone.utc) - timedelta(days=7)
+    weekly_withdrawals = await db.withdrawals.find({
+        "user_id": user['id'],
+        "status": "processed",
+        "processed_at": {"$gte": week_ago.isoformat()}
+    }).to_list(None)
+    
+    weekly_total = sum(w['amount'] for w in weekly_withdrawals)
+    if weekly_total + amount > WEEKLY_WITHDRAW_LIMIT_BRL:
+        errors.append(f"Limite semanal: R$ {WEEKLY_WITHDRAW_LIMIT_BRL:.2f}")
+    
+    return errors
+
 # Routes
 @api_router.post("/auth/register")
 async def register(data: UserRegister):
@@ -249,12 +814,13 @@ async def login(data: UserLogin):
     
     token = create_token(user['id'])
     del user['password']
+    user.pop('refunded_withdrawals', None)
     
     return {"token": token, "user": user}
 
 @api_router.get("/user/{user_id}")
 async def get_user(user_id: str):
-    user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0, "refunded_withdrawals": 0})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -270,6 +836,53 @@ async def get_user(user_id: str):
         "coins_per_real": COINS_PER_CENT
     }
 
+@api_router.get("/bootstrap/{user_id}")
+async def session_bootstrap(user_id: str, request: Request, history_limit: int = 30):
+    """Everything an app screen needs on mount, from a single user read"""
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0, "refunded_withdrawals": 0})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    user = await check_and_reset_daily(user)
+    money_balance = round(user['coins'] / COINS_PER_CENT, 2)
+    
+    ad_status, withdraw_errors, history, withdrawals = await asyncio.gather(
+        get_ad_status(user),
+        get_withdraw_errors(user, 0),
+        find_ads_events(user_id, reward_granted=True, limit=history_limit),
+        db.withdrawals.find({"user_id": user_id}, {"_id": 0}).to_list(None)
+    )
+    
+    payload = jsonable_encoder({
+        "user": {
+            **user,
+            "money_balance": money_balance,
+            "coins_per_real": COINS_PER_CENT
+        },
+        "balance": {
+            "coins": user['coins'],
+            "money_balance": money_balance
+        },
+        "ad_status": ad_status,
+        "eligibility": {
+            "can_withdraw": not withdraw_errors,
+            "withdraw_errors": withdraw_errors,
+            "needs_entry_ad": not user['first_game_ad_done'],
+            "daily_unlocked": user['daily_access_unlocked']
+        },
+        "history": history,
+        "withdrawals": withdrawals
+    })
+    
+    # seconds_remaining ticks down every second; the client derives it from next_allowed_time
+    hashed = {**payload, "ad_status": {k: v for k, v in payload['ad_status'].items() if k != "seconds_remaining"}}
+    etag = '"' + hashlib.sha1(json.dumps(hashed, sort_keys=True).encode('utf-8')).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    
+    return JSONResponse(payload, headers=headers)
+
 @api_router.get("/games")
 async def get_games():
     games = [
@@ -333,10 +946,13 @@ async def game_complete(data: GameComplete):
     
     # Reward coins for level completion
     if data.level_completed:
-        await db.users.update_one(
+        updated = await db.users.find_one_and_update(
             {"id": data.user_id},
-            {"$inc": {"coins": 50}}
+            {"$inc": {"coins": 50}},
+            projection={"_id": 0, "coins": 1},
+            return_document=ReturnDocument.AFTER
         )
+        await publish_balance(data.user_id, updated['coins'])
     
     return {"success": True, "total_play_time": new_total}
 
@@ -348,57 +964,7 @@ async def ad_request(data: AdRequest):
     
     user = await check_and_reset_daily(user)
     
-    now = datetime.now(timezone.utc)
-    
-    # Get last hour ads
-    last_hour_ads = await get_ads_last_hour(data.user_id)
-    ads_last_hour_count = len(last_hour_ads)
-    
-    # Check daily limit
-    if user['ads_today_count'] >= DAILY_AD_LIMIT:
-        return {
-            "allow": True,
-            "allowReward": False,
-            "reason": "daily_limit_reached",
-            "next_allowed_time": (now + timedelta(days=1)).replace(hour=0, minute=0).isoformat()
-        }
-    
-    # Check hourly limit
-    if ads_last_hour_count >= HOURLY_AD_LIMIT:
-        # Find oldest ad in last hour
-        oldest_ad = min(last_hour_ads, key=lambda x: x['timestamp'])
-        next_time = datetime.fromisoformat(oldest_ad['timestamp']) + timedelta(hours=1)
-        
-        return {
-            "allow": True,
-            "allowReward": False,
-            "reason": "hourly_limit_reached",
-            "next_allowed_time": next_time.isoformat(),
-            "ads_last_hour": ads_last_hour_count
-        }
-    
-    # Check cooldown
-    ads_timestamps = user.get('ads_timestamps', [])
-    if ads_timestamps:
-        last_ad_time = datetime.fromisoformat(ads_timestamps[-1])
-        time_since_last = (now - last_ad_time).total_seconds()
-        
-        if time_since_last < AD_COOLDOWN_SECONDS:
-            next_time = last_ad_time + timedelta(seconds=AD_COOLDOWN_SECONDS)
-            return {
-                "allow": False,
-                "allowReward": False,
-                "reason": "cooldown",
-                "next_allowed_time": next_time.isoformat(),
-                "seconds_remaining": int(AD_COOLDOWN_SECONDS - time_since_last)
-            }
-    
-    return {
-        "allow": True,
-        "allowReward": True,
-        "ads_today_count": user['ads_today_count'],
-        "ads_last_hour": ads_last_hour_count
-    }
+    return await get_ad_status(user)
 
 @api_router.post("/ads/complete")
 async def ad_complete(data: AdComplete):
@@ -410,11 +976,7 @@ async def ad_complete(data: AdComplete):
     now = datetime.now(timezone.utc)
     
     # Check if reward should be granted
-    request_result = await ad_request(AdRequest(
-        user_id=data.user_id,
-        game_id=data.game_id,
-        ad_type=data.ad_type
-    ))
+    request_result = await get_ad_status(user)
     
     reward_granted = request_result['allowReward']
     reward_amount = 0
@@ -431,18 +993,22 @@ async def ad_complete(data: AdComplete):
             reward_amount = STANDARD_AD_REWARD_COINS
         
         # Grant coins
-        await db.users.update_one(
+        updated = await db.users.find_one_and_update(
             {"id": data.user_id},
             {
                 "$inc": {"coins": reward_amount, "ads_today_count": 1, "ads_total_count": 1},
                 "$push": {"ads_timestamps": now.isoformat()}
-            }
+            },
+            projection=AD_STATUS_PROJECTION,
+            return_document=ReturnDocument.AFTER
         )
     else:
         # Still count as ad viewed but no reward
-        await db.users.update_one(
+        updated = await db.users.find_one_and_update(
             {"id": data.user_id},
-            {"$push": {"ads_timestamps": now.isoformat()}}
+            {"$push": {"ads_timestamps": now.isoformat()}},
+            projection=AD_STATUS_PROJECTION,
+            return_document=ReturnDocument.AFTER
         )
     
     # Log ad event
@@ -457,6 +1023,15 @@ async def ad_complete(data: AdComplete):
     }
     await db.ads_events.insert_one(ad_event)
     
+    # Whichever limit (cooldown, hourly, daily) now binds decides the next ad time
+    ad_status = await get_ad_status(updated)
+    await publish_balance(
+        data.user_id,
+        updated['coins'],
+        next_ad_time=ad_status.get('next_allowed_time'),
+        ad_limit_reason=ad_status.get('reason')
+    )
+    
     # Check fraud
     await check_fraud_signals(data.user_id)
     
@@ -481,19 +1056,12 @@ async def get_ranking(period: str = "today"):
         start = now.replace(day=1, hour=0, minute=0, second=0)
     
     # Aggregate coins earned in period
-    pipeline = [
-        {"$match": {"timestamp": {"$gte": start.isoformat()}, "reward_granted": True}},
-        {"$group": {"_id": "$user_id", "coins_earned": {"$sum": "$reward_amount"}}},
-        {"$sort": {"coins_earned": -1}},
-        {"$limit": 40}
-    ]
-    
-    user_rankings = await db.ads_events.aggregate(pipeline).to_list(None)
+    user_rankings = await coins_earned_by_user(start.isoformat(), 40)
     
     # Get user details
     ranking = []
     for item in user_rankings:
-        user = await db.users.find_one({"id": item['_id']}, {"_id": 0, "password": 0})
+        user = await db.users.find_one({"id": item['_id']}, {"_id": 0, "password": 0, "refunded_withdrawals": 0})
         if user:
             ranking.append({
                 "user_id": user['id'],
@@ -538,51 +1106,7 @@ async def request_withdraw(data: WithdrawRequest):
     user = await check_and_reset_daily(user)
     
     # Check requirements
-    errors = []
-    
-    money_balance = user['coins'] / COINS_PER_CENT
-    
-    if not user['daily_access_unlocked']:
-        errors.append("Você precisa assistir 5 anúncios diários para liberar o saque")
-    
-    if not user['first_game_ad_done']:
-        errors.append("Você precisa assistir o anúncio ao entrar no jogo")
-    
-    if money_balance < MIN_WITHDRAW_BRL:
-        errors.append(f"Saldo mínimo: R$ {MIN_WITHDRAW_BRL:.2f}")
-    
-    if user['total_play_time'] < MIN_PLAY_TIME_MINUTES * 60:
-        errors.append(f"Tempo mínimo de jogo: {MIN_PLAY_TIME_MINUTES} minutos")
-    
-    if len(user.get('games_played_distinct', [])) < MIN_GAMES_PLAYED:
-        errors.append(f"Você precisa jogar pelo menos {MIN_GAMES_PLAYED} jogos diferentes")
-    
-    if user['suspect_flag']:
-        errors.append("Sua conta está sob análise. Entre em contato com o suporte.")
-    
-    # Check device cooldown
-    last_withdraw = await db.withdrawals.find_one(
-        {"device_id": user['device_id'], "status": "processed"},
-        sort=[("processed_at", -1)]
-    )
-    
-    if last_withdraw and last_withdraw.get('processed_at'):
-        last_time = datetime.fromisoformat(last_withdraw['processed_at'])
-        hours_since = (datetime.now(timezone.utc) - last_time).total_seconds() / 3600
-        if hours_since < WITHDRAW_DEVICE_COOLDOWN_HOURS:
-            errors.append(f"Aguarde {int(WITHDRAW_DEVICE_COOLDOWN_HOURS - hours_since)}h para próximo saque")
-    
-    # Check weekly limit
-    week_ago = datetime.now(timezone.utc) - timedelta(days=7)
-    weekly_withdrawals = await db.withdrawals.find({
-        "user_id": data.user_id,
-        "status": "processed",
-        "processed_at": {"$gte": week_ago.isoformat()}
-    }).to_list(None)
-    
-    weekly_total = sum(w['amount'] for w in weekly_withdrawals)
-    if weekly_total + data.amount > WEEKLY_WITHDRAW_LIMIT_BRL:
-        errors.append(f"Limite semanal: R$ {WEEKLY_WITHDRAW_LIMIT_BRL:.2f}")
+    errors = await get_withdraw_errors(user, data.amount)
     
     if errors:
         raise HTTPException(status_code=400, detail={"errors": errors})
@@ -637,10 +1161,7 @@ async def create_ticket(data: SupportTicket):
 
 @api_router.get("/coins-history/{user_id}")
 async def get_coins_history(user_id: str, limit: int = 30):
-    events = await db.ads_events.find(
-        {"user_id": user_id, "reward_granted": True},
-        {"_id": 0}
-    ).sort("timestamp", -1).limit(limit).to_list(None)
+    events = await find_ads_events(user_id, reward_granted=True, limit=limit)
     
     return {"history": events}
 
@@ -654,7 +1175,7 @@ async def get_pending_withdrawals():
     
     # Enrich with user data
     for w in withdrawals:
-        user = await db.users.find_one({"id": w['user_id']}, {"_id": 0, "password": 0})
+        user = await db.users.find_one({"id": w['user_id']}, {"_id": 0, "password": 0, "refunded_withdrawals": 0})
         w['user'] = user
     
     return {"withdrawals": withdrawals}
@@ -665,38 +1186,78 @@ async def admin_withdrawal_action(data: AdminAction):
     if not withdrawal:
         raise HTTPException(status_code=404, detail="Withdrawal not found")
     
+    claimed = await apply_withdrawal_action([data.withdrawal_id], data.action, data.reason)
+    if not claimed:
+        raise HTTPException(status_code=409, detail="Withdrawal already processed")
+    
     if data.action == "approve":
-        await db.withdrawals.update_one(
-            {"id": data.withdrawal_id},
-            {"$set": {
-                "status": "processed",
-                "processed_at": datetime.now(timezone.utc).isoformat()
-            }}
-        )
         return {"success": True, "message": "Saque aprovado"}
+    return {"success": True, "message": "Saque rejeitado e moedas devolvidas"}
+
+@api_router.post("/admin/withdrawal-action/bulk")
+async def admin_bulk_withdrawal_action(data: AdminBulkAction):
+    claimed = await apply_withdrawal_action(data.withdrawal_ids, data.action, data.reason)
+    claimed_ids = {w['id'] for w in claimed}
     
-    elif data.action == "reject":
-        # Refund coins
-        await db.users.update_one(
-            {"id": withdrawal['user_id']},
-            {"$inc": {"coins": withdrawal['coins_deducted']}}
-        )
-        
-        await db.withdrawals.update_one(
-            {"id": data.withdrawal_id},
-            {"$set": {
-                "status": "rejected",
-                "reject_reason": data.reason,
-                "processed_at": datetime.now(timezone.utc).isoformat()
-            }}
-        )
-        return {"success": True, "message": "Saque rejeitado e moedas devolvidas"}
+    return {
+        "success": True,
+        "processed": len(claimed_ids),
+        "withdrawal_ids": sorted(claimed_ids),
+        "skipped_ids": [w_id for w_id in data.withdrawal_ids if w_id not in claimed_ids]
+    }
+
+@api_router.post("/admin/withdrawals/retry-refunds")
+async def admin_retry_refunds():
+    """Re-apply refunds left pending by a failed reject"""
+    withdrawals = await db.withdrawals.find(
+        {"status": "rejected", "refund_pending": True},
+        {"_id": 0}
+    ).to_list(None)
+    await refund_withdrawals(withdrawals)
+    
+    return {"success": True, "refunded": len(withdrawals)}
+
+@api_router.get("/admin/withdrawals/export")
+async def export_approved_withdrawals(since: Optional[str] = None):
+    """Stream approved PIX payouts as CSV"""
+    query = {"status": "processed", "method": "pix"}
+    if since:
+        query["processed_at"] = {"$gte": since}
+    
+    cursor = db.withdrawals.find(
+        query,
+        {"_id": 0, "id": 1, "user_id": 1, "amount": 1, "pix_key": 1, "processed_at": 1}
+    ).sort("processed_at", 1)
+    
+    async def rows():
+        fields = ["id", "user_id", "amount", "pix_key", "processed_at"]
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        async for w in cursor:
+            writer.writerow(w)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        if buffer.tell():
+            yield buffer.getvalue()
+    
+    return StreamingResponse(
+        rows(),
+        media_type="text/csv",
+        headers={"Content-Disposition": "attachment; filename=pix_payouts.csv"}
+    )
+
+@api_router.post("/admin/archive-ads-events")
+async def admin_archive_ads_events(retention_days: int = Query(ADS_EVENTS_RETENTION_DAYS, ge=1)):
+    result = await archive_ads_events(retention_days)
+    return {"success": True, **result}
 
 @api_router.get("/admin/suspects")
 async def get_suspect_users():
     suspects = await db.users.find(
         {"suspect_flag": True},
-        {"_id": 0, "password": 0}
+        {"_id": 0, "password": 0, "refunded_withdrawals": 0}
     ).to_list(None)
     
     # Get fraud flags
@@ -713,7 +1274,7 @@ async def clear_suspect(user_id: str):
 
 @api_router.get("/user/sync-balance/{user_id}")
 async def sync_balance(user_id: str):
-    user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0, "refunded_withdrawals": 0})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -722,6 +1283,45 @@ async def sync_balance(user_id: str):
         "money_balance": round(user['coins'] / COINS_PER_CENT, 2)
     }
 
+@api_router.get("/user/stream/{user_id}")
+async def stream_user_events(user_id: str, request: Request, token: str = Query(...)):
+    """Server-Sent Events stream of balance, ad cooldown and withdrawal changes"""
+    # EventSource cannot send headers, so the JWT comes in the query string
+    if verify_token(token).get('user_id') != user_id:
+        raise HTTPException(status_code=403, detail="Token does not match user")
+    if not await db.users.find_one({"id": user_id}, {"_id": 0, "id": 1}):
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    client = client_address(request)
+    error = broker.capacity_error(user_id, client)
+    if error:
+        raise error
+    
+    async def events():
+        # Register inside the generator so the finally always releases the slot
+        if broker.capacity_error(user_id, client):
+            # Filled up since the check above: tell EventSource to back off before reconnecting
+            yield f"retry: {STREAM_FULL_RETRY_MS}\ndata: {json.dumps({'type': 'unavailable'})}\n\n"
+            return
+        queue = broker.subscribe(user_id, client)
+        try:
+            yield ": connected\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            broker.unsubscribe(user_id, client, queue)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Include router
 app.include_router(api_router)
 
@@ -739,6 +1339,22 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    await db.ads_events_rollup.create_index([("user_id", 1), ("day", -1)])
+
+@app.on_event("startup")
+async def raise_open_files_limit():
+    """Raise the soft open-files limit to the hard limit and size the stream cap to it"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = hard if hard != resource.RLIM_INFINITY else max(soft, 1048576)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        soft = target
+    except (ValueError, OSError):
+        pass
+    broker.max_connections = stream_connection_cap(soft)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
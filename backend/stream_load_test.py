@@ -0,0 +1,135 @@
+"""Hold many idle connections on the balance stream.
+
+Usage: python stream_load_test.py --url http://localhost:8001 --connections 20000
+
+Seeds load-test users (ids "loadtest-<n>") into MONGO_URL/DB_NAME, opens
+MAX_STREAMS_PER_USER streams per user and removes the users afterwards
+(--no-seed skips both). All streams come from one client address, so run
+the server with MAX_STREAMS_PER_CLIENT above --connections.
+
+Every stream costs one descriptor on each side: both the server and this
+script need an open-files limit (ulimit -n) above --connections. The
+server raises its soft limit to the hard limit at startup and, unless
+MAX_STREAM_CONNECTIONS is set, caps streams at that limit minus 1024.
+A single source address gets at most the local port range
+(net.ipv4.ip_local_port_range) of connections to one server address.
+"""
+import argparse
+import asyncio
+import math
+import os
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+from pymongo import MongoClient
+
+from server import MAX_STREAMS_PER_USER, create_token
+
+LOADTEST_PREFIX = "loadtest-"
+
+
+def seed_users(count: int) -> None:
+    users = MongoClient(os.environ['MONGO_URL'])[os.environ['DB_NAME']].users
+    users.delete_many({"id": {"$regex": f"^{LOADTEST_PREFIX}"}})
+    now = datetime.now(timezone.utc).isoformat()
+    users.insert_many([
+        {"id": f"{LOADTEST_PREFIX}{i}", "name": "Load Test", "email": f"{LOADTEST_PREFIX}{i}@example.com",
+         "coins": 0, "last_daily_reset": now, "created_at": now}
+        for i in range(count)
+    ])
+
+
+def remove_users() -> None:
+    users = MongoClient(os.environ['MONGO_URL'])[os.environ['DB_NAME']].users
+    users.delete_many({"id": {"$regex": f"^{LOADTEST_PREFIX}"}})
+
+
+async def open_stream(host: str, port: int, user_id: str, token: str, ready: set, failed: list,
+                      handshakes: asyncio.Semaphore, stop: asyncio.Event):
+    try:
+        # Bound in-flight handshakes so the ramp does not overflow the accept backlog
+        async with handshakes:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(
+                f"GET /api/user/stream/{user_id}?token={token} HTTP/1.1\r\n"
+                f"Host: {host}\r\n"
+                "Accept: text/event-stream\r\n\r\n".encode()
+            )
+            await writer.drain()
+            status_line = await reader.readline()
+        if b" 200 " not in status_line:
+            failed.append(status_line.decode().strip() or "no response")
+            writer.close()
+            return
+        key = object()
+        ready.add(key)
+
+        # Drain keepalives until the test ends
+        stopped = asyncio.ensure_future(stop.wait())
+        while True:
+            read = asyncio.ensure_future(reader.read(1024))
+            await asyncio.wait({read, stopped}, return_when=asyncio.FIRST_COMPLETED)
+            if stopped.done():
+                read.cancel()
+                break
+            if not read.result():
+                failed.append("closed by server")
+                ready.discard(key)
+                stopped.cancel()
+                return
+        writer.close()
+    except OSError as e:
+        failed.append(str(e))
+
+
+async def main(url: str, connections: int, hold: int, concurrency: int):
+    parsed = urlparse(url)
+    host, port = parsed.hostname, parsed.port or 80
+    users = math.ceil(connections / MAX_STREAMS_PER_USER)
+    tokens = [create_token(f"{LOADTEST_PREFIX}{i}") for i in range(users)]
+    ready, failed = set(), []
+    handshakes = asyncio.Semaphore(concurrency)
+    stop = asyncio.Event()
+
+    start = time.monotonic()
+    tasks = [
+        asyncio.create_task(open_stream(
+            host, port, f"{LOADTEST_PREFIX}{i % users}", tokens[i % users], ready, failed, handshakes, stop
+        ))
+        for i in range(connections)
+    ]
+    while len(ready) + len(failed) < connections:
+        print(f"{time.monotonic() - start:6.0f}s ramping open={len(ready)} failed={len(failed)}", flush=True)
+        await asyncio.sleep(5)
+    print(f"ramp done in {time.monotonic() - start:.0f}s", flush=True)
+
+    end = time.monotonic() + hold
+    while time.monotonic() < end:
+        print(f"{time.monotonic() - start:6.0f}s holding open={len(ready)} failed={len(failed)}", flush=True)
+        await asyncio.sleep(10)
+
+    stop.set()
+    held = len(ready)
+    await asyncio.gather(*tasks)
+    print(f"held {held}/{connections} connections for {hold}s, {len(failed)} failed")
+    if failed:
+        print("first failures:", failed[:5])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--connections", type=int, default=20000)
+    parser.add_argument("--hold", type=int, default=120, help="seconds to keep the connections open after the ramp")
+    parser.add_argument("--concurrency", type=int, default=100, help="handshakes in flight during the ramp")
+    parser.add_argument("--no-seed", dest="seed", action="store_false", help="use existing loadtest-<n> users")
+    args = parser.parse_args()
+
+    if args.seed:
+        seed_users(math.ceil(args.connections / MAX_STREAMS_PER_USER))
+    try:
+        asyncio.run(main(args.url, args.connections, args.hold, args.concurrency))
+    finally:
+        if args.seed:
+            remove_users()
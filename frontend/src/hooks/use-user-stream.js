@@ -0,0 +1,25 @@
+import { useEffect, useRef } from 'react';
+
+const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
+
+// Subscribe to the server's balance/withdrawal push stream for the logged-in user
+export function useUserStream(onEvent) {
+  const handlerRef = useRef(onEvent);
+  handlerRef.current = onEvent;
+
+  useEffect(() => {
+    const storedUser = JSON.parse(localStorage.getItem('user'));
+    const token = localStorage.getItem('token');
+    if (!storedUser || !token) return undefined;
+
+    const stream = new EventSource(
+      `${API}/user/stream/${storedUser.id}?token=${encodeURIComponent(token)}`
+    );
+    stream.onmessage = (message) => handlerRef.current(JSON.parse(message.data));
+    return () => stream.close();
+  }, []);
+}
+
+export function applyBalance(prev, event) {
+  return prev && { ...prev, coins: event.coins, money_balance: event.money_balance };
+}
@@ -3,9 +3,10 @@ import { useNavigate } from 'react-router-dom';
 import axios from 'axios';
 import { Button } from '@/components/ui/button';
 import { Card, CardContent, CardDescription, CardHeader, CardTitle } from '@/components/ui/card';
-import { ArrowLeft, RefreshCw, Coins } from 'lucide-react';
+import { ArrowLeft, Coins } from 'lucide-react';
 import { toast } from 'sonner';
 import AdBanner from '../components/AdBanner';
+import { useUserStream, applyBalance } from '@/hooks/use-user-stream';
 
 const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
 
@@ -19,16 +20,19 @@ export default function CoinsPage() {
     loadData();
   }, []);
 
+  useUserStream((event) => {
+    if (event.type === 'balance') {
+      setUser(prev => applyBalance(prev, event));
+    }
+  });
+
   const loadData = async () => {
     try {
       const storedUser = JSON.parse(localStorage.getItem('user'));
-      const [userResponse, historyResponse] = await Promise.all([
-        axios.get(`${API}/user/${storedUser.id}`),
-        axios.get(`${API}/coins-history/${storedUser.id}`)
-      ]);
+      const response = await axios.get(`${API}/bootstrap/${storedUser.id}`);
       
-      setUser(userResponse.data);
-      setHistory(historyResponse.data.history);
+      setUser(response.data.user);
+      setHistory(response.data.history);
     } catch (error) {
       console.error('Error loading data:', error);
       toast.error('Erro ao carregar dados');
@@ -37,21 +41,6 @@ export default function CoinsPage() {
     }
   };
 
-  const handleSync = async () => {
-    try {
-      const storedUser = JSON.parse(localStorage.getItem('user'));
-      const response = await axios.get(`${API}/user/sync-balance/${storedUser.id}`);
-      toast.success('Saldo sincronizado!');
-      setUser(prev => ({
-        ...prev,
-        coins: response.data.coins,
-        money_balance: response.data.money_balance
-      }));
-    } catch (error) {
-      toast.error('Erro ao sincronizar');
-    }
-  };
-
   if (loading) {
     return (
       <div className="min-h-screen flex items-center justify-center" style={{background: 'linear-gradient(135deg, #667eea 0%, #764ba2 100%)'}}>
@@ -80,9 +69,6 @@ export default function CoinsPage() {
                 <Coins className="w-6 h-6" />
                 Saldo Atual
               </span>
-              <Button variant="ghost" size="sm" onClick={handleSync} className="text-white" data-testid="sync-button">
-                <RefreshCw className="w-5 h-5" />
-              </Button>
             </CardTitle>
           </CardHeader>
           <CardContent className="pt-6">
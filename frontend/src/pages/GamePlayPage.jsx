@@ -8,6 +8,7 @@ import { ArrowLeft, Play, Pause, Trophy, Coins } from 'lucide-react';
 import { toast } from 'sonner';
 import { AdMob, AdMobRewardItem } from '@capacitor-community/admob';
 import AdBanner from '../components/AdBanner';
+import { useUserStream, applyBalance } from '@/hooks/use-user-stream';
 import SnakeGame from '../components/games/SnakeGame';
 import FlappyGame from '../components/games/FlappyGame';
 import MemoryGame from '../components/games/MemoryGame';
@@ -38,11 +39,36 @@ export default function GamePlayPage() {
     };
   }, []);
 
+  // Balance and ad cooldown are pushed after each ad or completed level
+  useUserStream((event) => {
+    if (event.type !== 'balance') return;
+    setUser(prev => applyBalance(prev, event));
+    // Past the hourly/daily limit ads still play (without reward), so only the cooldown locks the button
+    if (event.ad_limit_reason === 'cooldown' && event.next_ad_time) {
+      setNextAdTime(event.next_ad_time);
+      setCanWatchAd(false);
+    }
+  });
+
+  useEffect(() => {
+    if (!nextAdTime) return undefined;
+    const timeout = setTimeout(() => setCanWatchAd(true), Math.max(0, new Date(nextAdTime) - Date.now()));
+    return () => clearTimeout(timeout);
+  }, [nextAdTime]);
+
   const loadUserAndStartGame = async () => {
     try {
       const storedUser = JSON.parse(localStorage.getItem('user'));
-      const userResponse = await axios.get(`${API}/user/${storedUser.id}`);
-      setUser(userResponse.data);
+      const bootstrapResponse = await axios.get(`${API}/bootstrap/${storedUser.id}`);
+      setUser(bootstrapResponse.data.user);
+
+      const adStatus = bootstrapResponse.data.ad_status;
+      if (!adStatus.allow && adStatus.next_allowed_time) {
+        setNextAdTime(adStatus.next_allowed_time);
+        setCanWatchAd(false);
+      }
+
+      // /game/start creates the session, so it stays a separate POST
 
       const startResponse = await axios.post(`${API}/game/start`, {
         user_id: storedUser.id,
@@ -158,25 +184,6 @@ export default function GamePlayPage() {
       }
 
       setShowRewardedAd(false);
-      
-      // Update cooldown
-      setTimeout(async () => {
-        try {
-          const reqResponse = await axios.post(`${API}/ads/request`, {
-            user_id: user.id,
-            ad_type: 'rewarded'
-          });
-          
-          if (!reqResponse.data.allow && reqResponse.data.next_allowed_time) {
-            setNextAdTime(reqResponse.data.next_allowed_time);
-            setCanWatchAd(false);
-          } else {
-            setCanWatchAd(true);
-          }
-        } catch (error) {
-          console.error('Error checking ad availability:', error);
-        }
-      }, 1000);
     } catch (error) {
       console.error('Rewarded ad error:', error);
       setShowRewardedAd(false);
@@ -8,6 +8,7 @@ import { Progress } from '@/components/ui/progress';
 import { toast } from 'sonner';
 import { Coins, Gamepad2, Trophy, Wallet, HelpCircle, LogOut, Star } from 'lucide-react';
 import AdBanner from '../components/AdBanner';
+import { useUserStream, applyBalance } from '@/hooks/use-user-stream';
 
 const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
 
@@ -22,6 +23,12 @@ export default function HomePage() {
     loadUser();
   }, []);
 
+  useUserStream((event) => {
+    if (event.type === 'balance') {
+      setUser(prev => applyBalance(prev, event));
+    }
+  });
+
   const loadUser = async () => {
     try {
       const storedUser = JSON.parse(localStorage.getItem('user'));
@@ -72,7 +79,6 @@ export default function HomePage() {
       if (newCount >= 5) {
         toast.success('Acesso diário liberado! Agora você pode jogar.');
         setShowDailyModal(false);
-        loadUser();
       }
     } catch (error) {
       console.error('Error watching ad:', error);
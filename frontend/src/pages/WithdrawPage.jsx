@@ -8,6 +8,7 @@ import { Label } from '@/components/ui/label';
 import { ArrowLeft, Wallet, CheckCircle2, XCircle, Clock } from 'lucide-react';
 import { toast } from 'sonner';
 import AdBanner from '../components/AdBanner';
+import { useUserStream, applyBalance } from '@/hooks/use-user-stream';
 
 const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
 
@@ -26,13 +27,10 @@ export default function WithdrawPage() {
   const loadData = async () => {
     try {
       const storedUser = JSON.parse(localStorage.getItem('user'));
-      const [userResponse, withdrawalsResponse] = await Promise.all([
-        axios.get(`${API}/user/${storedUser.id}`),
-        axios.get(`${API}/withdrawals/${storedUser.id}`)
-      ]);
+      const response = await axios.get(`${API}/bootstrap/${storedUser.id}`);
       
-      setUser(userResponse.data);
-      setWithdrawals(withdrawalsResponse.data.withdrawals);
+      setUser(response.data.user);
+      setWithdrawals(response.data.withdrawals);
     } catch (error) {
       console.error('Error loading data:', error);
       toast.error('Erro ao carregar dados');
@@ -41,6 +39,16 @@ export default function WithdrawPage() {
     }
   };
 
+  useUserStream((event) => {
+    if (event.type === 'balance') {
+      setUser(prev => applyBalance(prev, event));
+    } else if (event.type === 'withdrawal') {
+      setWithdrawals(prev => prev.map(w => (
+        w.id === event.withdrawal_id ? { ...w, status: event.status, processed_at: event.processed_at } : w
+      )));
+    }
+  });
+
   const handleWithdraw = async (e) => {
     e.preventDefault();
     
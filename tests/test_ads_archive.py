@@ -0,0 +1,139 @@
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+DAY = "2025-01-01"
+DAY_START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def make_event(user_id, minutes, reward_granted=True, reward_amount=200, game_id="snake"):
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "ad_type": "rewarded",
+        "game_id": game_id,
+        "timestamp": (DAY_START + timedelta(minutes=minutes, microseconds=123)).isoformat(),
+        "reward_amount": reward_amount,
+        "reward_granted": reward_granted,
+    }
+
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "ADS_ARCHIVE_DIR", tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def events():
+    return [
+        make_event("u1", 5),
+        make_event("u2", 1, game_id=None),
+        make_event("u1", 10, reward_granted=False, reward_amount=0),
+        make_event("u1", 2, reward_amount=5000),
+        make_event("u2", 20),
+    ]
+
+
+def test_partition_round_trip(archive_dir, events):
+    server.write_ads_partition(DAY, events)
+
+    assert server.list_archived_days() == [DAY]
+    assert (archive_dir / f"day={DAY}").is_symlink()
+
+    rows = server.read_archived_ads_events()
+    expected = sorted(events, key=lambda e: e["timestamp"], reverse=True)
+    assert [r["id"] for r in rows] == [e["id"] for e in expected]
+    for row, event in zip(rows, expected):
+        assert row == {**event, "game_id": event["game_id"] or None}
+
+
+def test_read_filters_and_limit(archive_dir, events):
+    server.write_ads_partition(DAY, events)
+
+    rows = server.read_archived_ads_events(user_id="u1", reward_granted=True)
+    assert [r["timestamp"][11:16] for r in rows] == ["00:05", "00:02"]
+
+    rows = server.read_archived_ads_events(user_id="u1", limit=1)
+    assert [r["timestamp"][11:16] for r in rows] == ["00:10"]
+
+    assert server.read_archived_ads_events(user_id="missing") == []
+    assert server.read_archived_ads_events(user_id="u1", days=["2024-12-31"]) == []
+
+
+def test_read_spans_days_newest_first(archive_dir, events):
+    server.write_ads_partition(DAY, events)
+    next_day = (DAY_START + timedelta(days=1)).date().isoformat()
+    later = make_event("u1", 24 * 60 + 1)
+    server.write_ads_partition(next_day, [later])
+
+    rows = server.read_archived_ads_events(user_id="u1", reward_granted=True, limit=2)
+    assert [r["id"] for r in rows] == [later["id"], events[0]["id"]]
+
+    rows = server.read_archived_ads_events(user_id="u1", since=later["timestamp"])
+    assert [r["id"] for r in rows] == [later["id"]]
+
+
+def test_archived_coins_by_user(archive_dir, events):
+    server.write_ads_partition(DAY, events)
+
+    assert server.archived_coins_by_user(DAY_START.isoformat()) == {"u1": 5200, "u2": 400}
+    since = (DAY_START + timedelta(minutes=3)).isoformat()
+    assert server.archived_coins_by_user(since) == {"u1": 200, "u2": 200}
+
+
+def test_merge_rewrites_partition(archive_dir, events):
+    server.write_ads_partition(DAY, events[:3])
+
+    merged = server.merge_ads_partition(DAY, events[2:])
+
+    assert sorted(e["id"] for e in merged) == sorted(e["id"] for e in events)
+    assert len(server.read_archived_ads_events()) == len(events)
+    # Only the current version directory and the day symlink remain
+    assert sorted(p.is_symlink() for p in archive_dir.iterdir()) == [False, True]
+
+
+def test_reader_keeps_old_version_during_swap(archive_dir, events):
+    server.write_ads_partition(DAY, events[:2])
+    columns = server.load_ads_partition(DAY)
+
+    server.write_ads_partition(DAY, events)
+
+    # Already-mapped columns stay readable after the old version is removed
+    assert len(columns["timestamp"]) == 2
+    assert server._partition_row(columns, 0)["id"] in {e["id"] for e in events[:2]}
+    assert len(server.load_ads_partition(DAY)["timestamp"]) == len(events)
+
+
+def test_find_ads_events_uses_rollup_days(archive_dir, events, monkeypatch):
+    import asyncio
+    from mongomock_motor import AsyncMongoMockClient
+
+    db = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(server, "db", db)
+    server.write_ads_partition(DAY, events)
+    server.write_ads_partition("2024-12-31", [make_event("u1", -60)])
+
+    async def run():
+        # Only DAY is listed for u1, so 2024-12-31 is never opened
+        await db.ads_events_rollup.insert_one(
+            {"day": DAY, "user_id": "u1", "events": 3, "rewarded_events": 2, "coins_earned": 5200}
+        )
+        return (
+            await server.find_ads_events("u1", reward_granted=True),
+            await server.find_ads_events("u1", reward_granted=False),
+            await server.find_ads_events("u1"),
+        )
+
+    rewarded, not_rewarded, everything = asyncio.run(run())
+    assert len(rewarded) == 2
+    assert [e["timestamp"][11:16] for e in not_rewarded] == ["00:10"]
+    assert len(everything) == 3
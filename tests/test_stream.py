@@ -0,0 +1,83 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import pytest
+from starlette.requests import Request
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+def make_request(client="10.0.0.1", forwarded=None):
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+    return Request({"type": "http", "headers": headers, "client": (client, 1234)})
+
+
+def test_client_address_uses_trusted_hops(monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 1)
+    assert server.client_address(make_request(forwarded="6.6.6.6, 1.2.3.4")) == "1.2.3.4"
+    assert server.client_address(make_request()) == "10.0.0.1"
+
+    monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 0)
+    assert server.client_address(make_request(forwarded="1.2.3.4")) == "10.0.0.1"
+
+
+def test_broker_limits_and_release():
+    broker = server.InProcessBroker(max_connections=3, max_per_user=2, max_per_client=10)
+
+    first = broker.subscribe("u1", "ip")
+    broker.subscribe("u1", "ip")
+    assert broker.capacity_error("u1", "ip").status_code == 429
+    broker.subscribe("u2", "ip")
+    assert broker.capacity_error("u3", "ip").status_code == 503
+
+    broker.unsubscribe("u1", "ip", first)
+    broker.unsubscribe("u1", "ip", first)
+    assert broker.connections == 2
+    assert broker.capacity_error("u1", "ip") is None
+
+
+def test_broker_drops_oldest_when_queue_full():
+    broker = server.InProcessBroker(max_connections=1, max_per_user=1, max_per_client=1)
+    queue = broker.subscribe("u1", "ip")
+
+    async def publish():
+        for i in range(server.STREAM_QUEUE_SIZE + 1):
+            await broker.publish("u1", {"n": i})
+    asyncio.run(publish())
+
+    assert queue.qsize() == server.STREAM_QUEUE_SIZE
+    assert queue.get_nowait() == {"n": 1}
+
+
+def test_stream_full_after_check_sends_retry(monkeypatch):
+    from mongomock_motor import AsyncMongoMockClient
+
+    db = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(server, "db", db)
+    broker = server.InProcessBroker(max_connections=1, max_per_user=3, max_per_client=10)
+    monkeypatch.setattr(server, "broker", broker)
+
+    async def run():
+        await db.users.insert_one({"id": "u1"})
+        response = await server.stream_user_events("u1", make_request(), token=server.create_token("u1"))
+        # Another stream takes the last slot before the body starts
+        other = broker.subscribe("u2", "other")
+        chunks = [chunk async for chunk in response.body_iterator]
+        broker.unsubscribe("u2", "other", other)
+        return chunks
+
+    chunks = asyncio.run(run())
+    assert len(chunks) == 1
+    assert chunks[0].startswith(f"retry: {server.STREAM_FULL_RETRY_MS}\n")
+    assert json.loads(chunks[0].split("data: ")[1]) == {"type": "unavailable"}
+    assert broker.connections == 0
+
+
+def test_stream_rejects_token_for_other_user():
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(server.stream_user_events("u1", make_request(), token=server.create_token("u2")))
+    assert exc.value.status_code == 403
@@ -0,0 +1,118 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(server, "db", db)
+    return db
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def seed(db, coins=0, withdrawals=("w1",), status="pending", **extra):
+    async def insert():
+        await db.users.insert_one({"id": "u1", "coins": coins})
+        await db.withdrawals.insert_many([
+            {"id": w_id, "user_id": "u1", "amount": 10.0, "coins_deducted": 1000,
+             "method": "pix", "pix_key": "key", "status": status, "processed_at": None, **extra}
+            for w_id in withdrawals
+        ])
+    run(insert())
+
+
+def coins(db):
+    return run(db.users.find_one({"id": "u1"}))["coins"]
+
+
+def withdrawal(db, w_id="w1"):
+    return run(db.withdrawals.find_one({"id": w_id}, {"_id": 0}))
+
+
+def test_approve_does_not_refund(db):
+    seed(db)
+
+    result = run(server.admin_withdrawal_action(server.AdminAction(withdrawal_id="w1", action="approve")))
+
+    assert result["success"]
+    assert withdrawal(db)["status"] == "processed"
+    assert coins(db) == 0
+
+
+def test_reject_refunds_once(db):
+    seed(db)
+
+    run(server.admin_withdrawal_action(server.AdminAction(withdrawal_id="w1", action="reject", reason="no")))
+
+    w = withdrawal(db)
+    assert (w["status"], w["reject_reason"], w["refund_pending"]) == ("rejected", "no", False)
+    assert coins(db) == 1000
+
+
+def test_second_action_conflicts(db):
+    seed(db)
+    run(server.admin_withdrawal_action(server.AdminAction(withdrawal_id="w1", action="reject")))
+
+    for action in ("reject", "approve"):
+        with pytest.raises(HTTPException) as exc:
+            run(server.admin_withdrawal_action(server.AdminAction(withdrawal_id="w1", action=action)))
+        assert exc.value.status_code == 409
+    assert coins(db) == 1000
+
+
+def test_bulk_reject_skips_handled_ids(db):
+    seed(db, withdrawals=("w1", "w2"))
+    run(server.admin_withdrawal_action(server.AdminAction(withdrawal_id="w1", action="approve")))
+
+    result = run(server.admin_bulk_withdrawal_action(
+        server.AdminBulkAction(withdrawal_ids=["w1", "w2", "w2"], action="reject")
+    ))
+
+    assert result["withdrawal_ids"] == ["w2"]
+    assert result["skipped_ids"] == ["w1"]
+    assert coins(db) == 1000
+
+
+def test_retry_refunds_pending(db):
+    # Crash after the reject claim, before the refund
+    seed(db, status="rejected", refund_pending=True)
+
+    assert run(server.admin_retry_refunds())["refunded"] == 1
+    assert run(server.admin_retry_refunds())["refunded"] == 0
+    assert coins(db) == 1000
+    assert withdrawal(db)["refund_pending"] is False
+
+
+def test_retry_after_refund_paid_does_not_pay_again(db):
+    # Crash after the refund, before refund_pending was cleared
+    seed(db, status="rejected", refund_pending=True)
+    run(db.users.update_one({"id": "u1"}, {"$set": {"coins": 1000, "refunded_withdrawals": ["w1"]}}))
+
+    run(server.admin_retry_refunds())
+
+    assert coins(db) == 1000
+    assert withdrawal(db)["refund_pending"] is False
+
+
+def test_concurrent_refunds_of_same_snapshot_pay_once(db):
+    seed(db, status="rejected", refund_pending=True)
+    snapshot = [withdrawal(db)]
+
+    async def both():
+        await asyncio.gather(server.refund_withdrawals(snapshot), server.refund_withdrawals(snapshot))
+    run(both())
+    run(server.refund_withdrawals(snapshot))
+
+    assert coins(db) == 1000